@@ -1,30 +1,149 @@
+import functools
+import io
 import os.path
-import random
 import pickle
+import random
+import sys
+import weakref
+from dataclasses import dataclass
+from typing import Any, Optional
+import msgpack
 from jsonschema import Draft4Validator, validators, ValidationError
 
+try:
+    import jsonschema_rs
+except ImportError:
+    jsonschema_rs = None
+
+_MISSING = object()
+
+# id(properties) -> [есть ли среди свойств default, число QueristValidator с этими properties].
+# Записи добавляет и удаляет QueristValidator, который держит схему, поэтому id не переиспользуется,
+# пока запись существует, и реестр не удерживает схемы в памяти.
+_has_defaults_registry = {}
+
+
+def _properties_have_defaults(properties):
+    return any('default' in subschema for subschema in properties.values() if isinstance(subschema, dict))
+
+
+def _has_defaults(properties):
+    entry = _has_defaults_registry.get(id(properties))
+    return _properties_have_defaults(properties) if entry is None else entry[0]
+
+
+def _register_has_defaults(flags):
+    for properties_id, has_defaults in flags.items():
+        entry = _has_defaults_registry.setdefault(properties_id, [has_defaults, 0])
+        entry[1] += 1
+
+
+def _unregister_has_defaults(flags, schema):
+    # schema передается, чтобы properties оставались живы до удаления записей
+    for properties_id in flags:
+        entry = _has_defaults_registry[properties_id]
+        entry[1] -= 1
+        if not entry[1]:
+            del _has_defaults_registry[properties_id]
+
+
+# Ключевые слова Draft 4, значения которых являются подсхемами
+_SCHEMA_KEYWORDS = ('additionalItems', 'additionalProperties', 'items', 'not')
+_SCHEMA_LIST_KEYWORDS = ('allOf', 'anyOf', 'items', 'oneOf')
+_SCHEMA_MAP_KEYWORDS = ('definitions', 'dependencies', 'patternProperties', 'properties')
+
+
+def _iter_subschemas(schema):
+    """ Непосредственные подсхемы схемы, без обхода значений default, enum и других данных """
+    for keyword in _SCHEMA_KEYWORDS:
+        if isinstance(schema.get(keyword), dict):
+            yield schema[keyword]
+    for keyword in _SCHEMA_LIST_KEYWORDS:
+        if isinstance(schema.get(keyword), list):
+            yield from (subschema for subschema in schema[keyword] if isinstance(subschema, dict))
+    for keyword in _SCHEMA_MAP_KEYWORDS:
+        if isinstance(schema.get(keyword), dict):
+            yield from (subschema for subschema in schema[keyword].values() if isinstance(subschema, dict))
+
+
+def _strip_annotations(schema):
+    """ Копия схемы без description, не являющихся строкой.
+
+    В схемах проекта description - объект с настройками модели, такая схема не проходит
+    проверку метасхемой и не компилируется jsonschema_rs.
+    """
+    if not isinstance(schema, dict):
+        return schema
+    stripped = {keyword: value for keyword, value in schema.items()
+                if keyword != 'description' or isinstance(value, str)}
+    for keyword in _SCHEMA_KEYWORDS:
+        if isinstance(stripped.get(keyword), dict):
+            stripped[keyword] = _strip_annotations(stripped[keyword])
+    for keyword in _SCHEMA_LIST_KEYWORDS:
+        if isinstance(stripped.get(keyword), list):
+            stripped[keyword] = [_strip_annotations(subschema) for subschema in stripped[keyword]]
+    for keyword in _SCHEMA_MAP_KEYWORDS:
+        if isinstance(stripped.get(keyword), dict):
+            stripped[keyword] = {name: _strip_annotations(subschema) for name, subschema in stripped[keyword].items()}
+    return stripped
+
+
+def _path_key(path):
+    """ Строковый ключ пути для _answers, например ('fields', ) -> '/fields'
+
+    Сегменты экранируются как в JSON Pointer ('~' -> '~0', '/' -> '~1'), а индексы массивов
+    записываются как '~i<номер>', поэтому ('items', 0) и ('items', '0') дают разные ключи.
+    """
+    return sys.intern(''.join('/~i{}'.format(segment) if isinstance(segment, int)
+                              else '/' + str(segment).replace('~', '~0').replace('/', '~1')
+                              for segment in path))
+
 
 def save_obj(obj, file_path):
     with open(file_path, 'wb') as f:
-        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        f.write(msgpack.packb(obj, use_bin_type=True))
+
+
+class _LegacyAnswersUnpickler(pickle.Unpickler):
+    """ Загрузка файлов ответов в старом формате pickle.
+
+    В них только dict, tuple и скалярные значения, поэтому любые глобальные объекты запрещены:
+    иначе подготовленный файл мог бы выполнить произвольный код.
+    """
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError('global {}.{} is forbidden in answers file'.format(module, name))
 
 
 def load_obj(file_path):
     with open(file_path, 'rb') as f:
-        return pickle.load(f)
+        data = f.read()
+    try:
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    except ValueError:
+        # файлы ответов, сохраненные до перехода на msgpack, записаны через pickle (протокол 2+ начинается с 0x80);
+        # после загрузки они пересохраняются в новом формате при следующем dump_answers
+        if not data.startswith(pickle.PROTO):
+            raise
+        return _LegacyAnswersUnpickler(io.BytesIO(data)).load()
 
 
 class ExtendedValidationError(ValidationError):
     def __init__(self, *args, **kwargs):
         self.property = kwargs.pop('property', None)
         super().__init__(*args, **kwargs)
+        # path дополняется родительскими элементами по мере всплытия ошибки, поэтому кортеж строится при первом запросе
+        self._path_tuple_cache = None
+        self._cached_pschema = _MISSING
 
     def get_property(self):
         return self.property
 
     def get_property_schema(self):
-        properties = self.schema.get('properties', {})
-        return properties.get(self.get_property(), {})
+        if self._cached_pschema is _MISSING:
+            properties = self.schema.get('properties', {})
+            self._cached_pschema = properties.get(self.get_property(), {})
+        return self._cached_pschema
 
     def get_root_instance(self):
         return self.instance
@@ -33,7 +152,9 @@ class ExtendedValidationError(ValidationError):
         return self.schema
 
     def get_property_path(self):
-        return tuple(self.path) + (self.property, )
+        if self._path_tuple_cache is None:
+            self._path_tuple_cache = (*self.path, self.property)
+        return self._path_tuple_cache
 
 
 class DefaultHandler(ExtendedValidationError):
@@ -46,7 +167,7 @@ class PropertyError(ExtendedValidationError):
         self._root_context = None
 
     def get_property(self):
-        return self.path[len(self.path) - 1]
+        return self.path[-1]
 
     def get_property_schema(self):
         return self.schema
@@ -58,7 +179,9 @@ class PropertyError(ExtendedValidationError):
         return self._root_context[0]
 
     def get_property_path(self):
-        return tuple(self.path)
+        if self._path_tuple_cache is None:
+            self._path_tuple_cache = tuple(self.path)
+        return self._path_tuple_cache
 
     def with_root(self, schema, instance):
         self._root_context = (schema, instance)
@@ -69,7 +192,35 @@ class RequiredError(ExtendedValidationError):
     pass
 
 
+@dataclass(slots=True)
+class PropInfo:
+    """ Заранее извлеченные из схемы свойства параметры default.
+
+    Хранит ссылку на схему, чтобы id(schema), по которому кэшируется запись, не мог быть переиспользован.
+    """
+    schema: Any
+    has_default: bool
+    default: Optional[dict]
+    default_value: Any
+    question_text: Optional[str]
+    prop_type: Any
+    enum: Optional[list]
+
+    @classmethod
+    def from_schema(cls, schema):
+        if not isinstance(schema, dict):
+            return cls(schema, False, None, None, None, None, None)
+        default = schema.get('default')
+        if not isinstance(default, dict):
+            return cls(schema, 'default' in schema, None, None, None, schema.get('type'), schema.get('enum'))
+        return cls(schema, True, default, default.get('value'), default.get('question'),
+                   schema.get('type'), schema.get('enum'))
+
+
 class Question(object):
+    __slots__ = ('_default_value', '_correction', '_enum', '_enum_set', '_question', '_required', '_type', '_choices',
+                 '_repr')
+
     SUPPORTED_TYPES = []
 
     _max_iterations = 5
@@ -78,6 +229,7 @@ class Question(object):
         self._default_value = default.get('value')
         self._correction = correction
         self._enum = prop_enum
+        self._enum_set = self._create_enum_set(prop_enum)
         self._question = default.get('question')
         self._required = required
         self._type = prop_type
@@ -87,7 +239,12 @@ class Question(object):
         else:
             self._choices = None
 
+        self._repr = self._create_repr() if isinstance(self._question, str) else None
+
     def __str__(self):
+        return self._repr if self._repr is not None else self._create_repr()
+
+    def _create_repr(self):
         question = 'question: "{}"'.format(self._question[:15])
         if len(self._question) > 15:
             question += '...'
@@ -102,6 +259,17 @@ class Question(object):
     def ask(self, key_value=None):
         raise NotImplementedError
 
+    @staticmethod
+    def _create_enum_set(enum):
+        """ Множество для проверки ответа, _enum остается списком для выбора по номеру """
+        if not enum:
+            return frozenset()
+        try:
+            return frozenset(enum)
+        except TypeError:
+            # в enum могут быть нехешируемые значения (объекты, массивы)
+            return enum
+
     @staticmethod
     def _create_choices_str(enum, dictionary=None):
         return ", ".join("{}. {}".format(index, dictionary and dictionary.get(choice) or choice)
@@ -109,6 +277,8 @@ class Question(object):
 
 
 class ConsoleQuestion(Question):
+    __slots__ = ()
+
     CMD_BREAK_ANSWER = "\q"
     MSG_CORRECTION = "Ошибка валидации\n"
     MSG_NOT_IN_ENUM = ("Такой ответ не входит в список возможных вариантов\n"
@@ -122,8 +292,9 @@ class ConsoleQuestion(Question):
         if self._correction:
             print(self.MSG_CORRECTION)
         print(self._question.format(default=self._default_value, key_value=key_value))
+        choices_msg = self.MSG_CHOICES.format(self._choices) if self._choices else ""
         for i in range(self._max_iterations):
-            answer = self._input(self.MSG_CHOICES.format(self._choices) if self._choices else "")
+            answer = self._input(choices_msg)
             if answer == self.CMD_BREAK_ANSWER:
                 answer = None
                 break
@@ -136,12 +307,12 @@ class ConsoleQuestion(Question):
                     break
                 print(self.MSG_REQUIRED)
             elif self._enum:
-                if answer in self._enum:
+                if answer in self._enum_set:
                     break
                 try:
                     answer = self._enum[int(answer)]
                     break
-                except TypeError:
+                except (TypeError, ValueError, IndexError):
                     pass
                 print(self.MSG_NOT_IN_ENUM)
             else:
@@ -157,9 +328,14 @@ class ConsoleQuestion(Question):
 
 
 class AutoAnswers(ConsoleQuestion):
+    __slots__ = ()
 
     MSG_RANDOM_ANSWER = "Случайный ответ: {}"
 
+    _RANDOM_GENERATORS = {"integer": lambda self: random.randint(0, 1000),
+                          "string": lambda self: self._random_word(10),
+                          "bool": lambda self: random.getrandbits(1) == 1}
+
     def _input(self, msg):
         print(msg)
         random_answer = self._random_answer()
@@ -167,20 +343,17 @@ class AutoAnswers(ConsoleQuestion):
         return random_answer
 
     def _random_answer(self):
-        mapping = {"integer": lambda: random.randint(0, 1000),
-                   "string": lambda: self._random_word(10),
-                   "bool": lambda: random.choice([True, False])}
         if self._enum:
             return random.choice(self._enum)
-        elif self._type in mapping:
-            return mapping[self._type]()
+        elif self._type in self._RANDOM_GENERATORS:
+            return self._RANDOM_GENERATORS[self._type](self)
         else:
             return ''
 
     @staticmethod
     def _random_word(length):
         letters = 'abcdefghijklmnopqrstuvwxyz'
-        return ''.join(random.choice(letters) for i in range(length))
+        return ''.join(random.choices(letters, k=length))
 
 
 class QueristValidator(object):
@@ -190,11 +363,19 @@ class QueristValidator(object):
             answers = load_obj(answers_file)
         else:
             answers = {}
-        self._answers = answers if isinstance(answers, dict) else {}
-        self._keys = {}
+        # в файлах pickle, сохраненных до перехода на строковые ключи, пути записаны кортежами
+        self._answers = {_path_key(key) if isinstance(key, tuple) else key: value
+                         for key, value in answers.items()} if isinstance(answers, dict) else {}
         self._make_question = question_class
-        self._questions = {}
+        self._question_cache = {}
         self._schema = schema
+        self._key_field_cache = {}
+        self._prop_info = {}
+        self._has_defaults = {}
+        self._collect_schema_info(self._schema)
+        _register_has_defaults(self._has_defaults)
+        weakref.finalize(self, _unregister_has_defaults, self._has_defaults, self._schema)
+        self._fast_validator = self._create_fast_validator(self._schema)
 
         self.base_validator = Draft4Validator(self._schema)
         self.validator = self._extend_with_default(Draft4Validator)(self._schema)
@@ -207,72 +388,132 @@ class QueristValidator(object):
         save_obj(self._answers, answers_file)
 
     def iter_errors(self, instance):
-        self._questions = {}
-        self._keys = {}
+        yielded = set()
+        patched = False
         for error in self.validator.iter_errors(instance, self._schema):
-            if isinstance(error, ExtendedValidationError):
-                is_required_error = type(error) is RequiredError
-                property_name = error.get_property()
-                subschema = error.get_property_schema()
-                instance = error.get_root_instance()
-
-                if is_required_error and not (isinstance(subschema, dict) and "default" in subschema):
+            handler = self._get_handler(type(error))
+            unresolved, resolved = handler(self, error) if handler else (error, False)
+            patched = patched or resolved
+            if unresolved is not None:
+                yielded.add(self._error_key(unresolved))
+                yield unresolved
+
+        if patched:
+            # default уже записаны в instance, поэтому одна повторная проверка охватывает все измененные свойства
+            for error in self._iter_revalidation_errors(instance):
+                if self._error_key(error) not in yielded:
                     yield error
-                    continue
-                self._resolve_default(error)  # здесь изменяется instance
-                if is_required_error and property_name not in instance:
-                    yield error
-                elif property_name in instance:
-                    yield from self.base_validator.iter_errors(instance[property_name], subschema)
-                    # todo поправлять path, проверить ErrorTree
-                    # todo отложенно проверять измененные экземпляры
 
-            else:
-                yield error
+    @classmethod
+    def _get_handler(cls, error_type):
+        if error_type not in cls._HANDLERS:
+            cls._HANDLERS[error_type] = next((cls._HANDLERS[base] for base in error_type.__mro__[1:]
+                                              if base in cls._HANDLERS), None)
+        return cls._HANDLERS[error_type]
+
+    def _handle_required(self, error):
+        prop_info = self._get_prop_info(error.get_property_schema())
+        if not prop_info.has_default or not self._resolve_default(error, prop_info):  # здесь изменяется root_instance
+            return error, False
+        return None, True
+
+    def _handle_default(self, error):
+        """ Обработчик DefaultHandler: если default не задан, свойство просто остается отсутствующим """
+        prop_info = self._get_prop_info(error.get_property_schema())
+        return None, self._resolve_default(error, prop_info)  # здесь изменяется root_instance
+
+    def _handle_property(self, error):
+        """ Обработчик PropertyError: без default исходная ошибка пробрасывается без повторной проверки """
+        prop_info = self._get_prop_info(error.get_property_schema())
+        if self._resolve_default(error, prop_info):  # здесь изменяется root_instance
+            return None, True
+        return error, False
+
+    # Обработчик возвращает (ошибка, которую нужно пробросить, или None; был ли дополнен instance).
+    # Функции хранятся несвязанными, чтобы таблица не создавала цикл ссылок на экземпляр.
+    # Подклассы без своего обработчика находятся по MRO и добавляются в таблицу при первой встрече
+    _HANDLERS = {ExtendedValidationError: _handle_default,
+                 RequiredError: _handle_required,
+                 DefaultHandler: _handle_default,
+                 PropertyError: _handle_property}
+
+    @staticmethod
+    def _error_key(error):
+        return tuple(error.path), error.validator, error.message
+
+    def _iter_revalidation_errors(self, instance):
+        """ Повторная проверка инстанса после подстановки default.
 
-    def _resolve_default(self, error):
+        Если установлен jsonschema_rs, сначала выполняется быстрая проверка скомпилированной схемой,
+        ошибки в формате jsonschema собираются через base_validator только для невалидных инстансов.
+        """
+        if self._fast_validator is not None:
+            try:
+                if self._fast_validator.is_valid(instance):
+                    return
+            except ValueError:
+                # jsonschema_rs не поддерживает значения вне JSON (например, bytes), их проверяет только jsonschema
+                pass
+        yield from self.base_validator.iter_errors(instance)
+
+    @staticmethod
+    def _create_fast_validator(schema):
+        if jsonschema_rs is None:
+            return None
+        try:
+            return jsonschema_rs.Draft4Validator(_strip_annotations(schema))
+        except ValueError:
+            # схема не проходит проверку метасхемой по другим причинам, проверяем только через jsonschema
+            return None
+
+    def _resolve_default(self, error, prop_info):
         """ Измененяет инстанс по инструкциям в default.
 
+        Args:
+            prop_info: PropInfo схемы свойства из error.get_property_schema()
+
         Returns:
             Если default не задан возвращает False, иначе True
         """
-        required = isinstance(error, RequiredError)
+        if prop_info.default is None:
+            return False
         path = error.get_property_path()
         property_name = error.get_property()
-        property_schema = error.get_property_schema()
-
-        if path not in self._questions:
-            default = property_schema.get('default')
-            if not isinstance(default, dict):
-                self._questions[path] = None
-                return False
-            if 'question' in default:
-                question = self._make_question(default,
-                                               property_schema.get('type'),
-                                               property_schema.get('enum'),
-                                               required,
-                                               type(error) != DefaultHandler)
-            else:
-                question = None
-            default_value = default.get('value', None)
-            self._questions[path] = question, default_value
+        # Вопрос зависит только от схемы свойства и типа ошибки, поэтому переиспользуется между инстансами
+        key = id(prop_info.schema), type(error)
+
+        if key in self._question_cache:
+            question = self._question_cache[key]
+        elif prop_info.question_text is not None:
+            self._question_cache[key] = question = self._make_question(prop_info.default,
+                                                                       prop_info.prop_type,
+                                                                       prop_info.enum,
+                                                                       isinstance(error, RequiredError),
+                                                                       type(error) != DefaultHandler)
         else:
-            question, default_value = self._questions[path]
+            self._question_cache[key] = question = None
 
-        error.get_root_instance()[property_name] = self._ask(path, error, question) if question else default_value
+        if question:
+            error.get_root_instance()[property_name] = self._ask(path, error, question)
+        else:
+            error.get_root_instance()[property_name] = prop_info.default_value
         return True
 
     def _ask(self, path, error, question):
-        key_path = path[:-1]
+        key_path = _path_key(path[:-1])
         if key_path in self._answers:
             answers = self._answers[key_path]
         else:
             self._answers[key_path] = answers = {}
 
-        if key_path in self._keys:
-            key = self._keys[key_path]
+        properties = error.get_root_schema().get('properties')
+        if properties is None:
+            key = None
+        elif id(properties) in self._key_field_cache:
+            key = self._key_field_cache[id(properties)]
         else:
-            self._keys[key_path] = key = self._get_key(error.get_root_schema().get('properties', {}))
+            # properties вне обхода схемы не кэшируются: кэш не держит на них ссылку, и id может быть переиспользован
+            key = self._get_key(properties)
 
         key_value = error.get_root_instance()[key]
 
@@ -295,25 +536,46 @@ class QueristValidator(object):
 
         return answer
 
+    def _collect_schema_info(self, schema):
+        """ Заранее находит key_field для всех properties в схеме и извлекает PropInfo для каждого свойства.
+
+        Ключи кэшей - id(properties) и id(схемы свойства) соответственно
+        """
+        if not isinstance(schema, dict):
+            return
+        properties = schema.get('properties')
+        if isinstance(properties, dict):
+            self._key_field_cache[id(properties)] = self._get_key(properties)
+            self._has_defaults[id(properties)] = _properties_have_defaults(properties)
+            for subschema in properties.values():
+                self._prop_info[id(subschema)] = PropInfo.from_schema(subschema)
+        for subschema in _iter_subschemas(schema):
+            self._collect_schema_info(subschema)
+
+    def _get_prop_info(self, schema):
+        # Схемы вне обхода (например, {} для свойства, не описанного в properties) не кэшируются:
+        # иначе каждая такая ошибка добавляла бы запись навсегда
+        info = self._prop_info.get(id(schema))
+        return PropInfo.from_schema(schema) if info is None else info
+
     @staticmethod
     def _get_key(properties):
-        for prop, subschema in properties.items():
-            default = subschema.get("default") if isinstance(subschema, dict) else None
-            if isinstance(default, dict):
-                key_field = default.get("key_field")
-                if key_field:
-                    return prop
-        else:
-            return None
+        return next((prop for prop, subschema in properties.items()
+                     if isinstance(subschema, dict)
+                     and isinstance(subschema.get("default"), dict)
+                     and subschema["default"].get("key_field")), None)
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def _extend_with_default(validator_class):
+        """ Расширенный класс не зависит от экземпляра, поэтому создается один раз на validator_class """
         validate_properties = validator_class.VALIDATORS["properties"]
 
         def set_defaults(validator, properties, instance, schema):
-            for prop, subschema in properties.items():
-                if prop not in instance and "default" in subschema:
-                    yield DefaultHandler("HandleDefault", property=prop)
+            if _has_defaults(properties):
+                for prop, subschema in properties.items():
+                    if prop not in instance and "default" in subschema:
+                        yield DefaultHandler("HandleDefault", property=prop)
 
             for error in validate_properties(validator, properties, instance, schema, ):
                 if type(error) is ValidationError:
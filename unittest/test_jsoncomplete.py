@@ -1,10 +1,15 @@
 import os
 import unittest
+import collections
 import copy
+import gc
 import random
 import json
+import pickle
+from unittest import mock
 from jsonschema import ValidationError
-from jsoncomplete import QueristValidator, AutoAnswers, load_obj
+import jsoncomplete
+from jsoncomplete import QueristValidator, AutoAnswers, ConsoleQuestion, DefaultHandler, PropertyError, RequiredError, load_obj, save_obj, _path_key
 
 SINGLE_TEST = False
 
@@ -81,12 +86,12 @@ class TestFixtures(unittest.TestCase):
                                     'initial_amount': 0,
                                     'fk_owner': 1}
 
-        answers = {('fields', ): {'answered': {'account_type': 'CC',
-                                               'currency': 'AMD',
-                                               'comment': "ok"}}}
+        answers = {'/fields': {'answered': {'account_type': 'CC',
+                                            'currency': 'AMD',
+                                            'comment': "ok"}}}
 
         should_be = copy.deepcopy(self.test_case)
-        should_be['fields'].update(answers[('fields', )]['answered'])
+        should_be['fields'].update(answers['/fields']['answered'])
 
         saved_answers = self.validator._answers
         self.validator._answers = answers
@@ -109,7 +114,7 @@ class TestFixtures(unittest.TestCase):
 
         duplicate = self.test_case['fields'].copy()
         self.validator.validate(self.test_case)
-        duplicate.update(self.validator._answers[('fields',)]['ask'])
+        duplicate.update(self.validator._answers['/fields']['ask'])
 
         self.assertDictEqual(self.test_case['fields'], duplicate)
 
@@ -119,21 +124,21 @@ class TestFixtures(unittest.TestCase):
         self.test_case['fields'] = {'account_name': 'random',
                                     'initial_amount': 0,
                                     'fk_owner': 1}
-        collection_saved = self.validator._questions
-        self.validator._questions = {}
+        collection_saved = self.validator._question_cache
+        self.validator._question_cache = {}
         for x in range(3):
             test_case = copy.deepcopy(self.test_case)
             test_case['fields']['account_name'] = 'random{}'.format(random.randint(0, 1000))
             self.validator.validate(test_case)
         # print('Collected: ', ', '.join(key for key in self.validator._question._collection))
         # Сколько вопросов кэшировано
-        collected_len = len(self.validator._questions)
+        collected_len = len(self.validator._question_cache)
         # Сколько свойств в схеме
         schema_len = len(self.validator._schema['properties']['fields']['properties'])
         # Сколько свойств определено в test_case (должны быть определены все для которых не вызывается default)
         defined_len = len(self.test_case['fields'])
 
-        self.validator._questions = collection_saved
+        self.validator._question_cache = collection_saved
         self.assertEqual(collected_len, schema_len - defined_len)
 
     @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
@@ -170,7 +175,7 @@ class TestFixtures(unittest.TestCase):
             test_case_copy['fields']['account_name'] = "fileIO_{}".format(index)
             validator.validate(test_case_copy)
 
-        answers_file = 'output/test.json'
+        answers_file = 'output/test.msgpack'
         self.test_case['fields'] = {"account_name": "fileIO",
                                     "fk_owner": 1}
 
@@ -188,6 +193,167 @@ class TestFixtures(unittest.TestCase):
 
         self.assertDictEqual(answers, self.validator._answers)
 
+    @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
+    def test_revalidation_error_path(self):
+        """ Ошибка в свойстве без default возвращается один раз и с полным путем """
+        self.test_case['fields'] = {'account_name': 'revalidation',
+                                    'fk_owner': 'x'}
+
+        errors = list(self.validator.iter_errors(self.test_case))
+
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(list(errors[0].path), ['fields', 'fk_owner'])
+
+    @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
+    def test_revalidation_non_json_value(self):
+        """ Значения вне JSON после подстановки default проверяются через jsonschema без исключений """
+        self.test_case['fields'] = {'account_name': 'non_json',
+                                    'fk_owner': b'x'}
+
+        errors = list(self.validator.iter_errors(self.test_case))
+
+        self.assertEqual([error.message for error in errors], ["b'x' is not of type 'integer'"])
+
+    @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
+    def test_missed_required_reported_once(self):
+        """ Отсутствующее обязательное свойство не сообщается повторно после подстановки default """
+        self.test_case['fields'] = {'account_name': 'missed_required_once'}
+
+        errors = list(self.validator.iter_errors(self.test_case))
+
+        self.assertEqual([error.message for error in errors], ["'fk_owner' is a required property"])
+
+    @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
+    def test_error_copy(self):
+        """ Дополнительные атрибуты ошибок сохраняются при copy, deepcopy и pickle """
+        required_error = RequiredError("'x' is a required property", property='x')
+        property_error = PropertyError('broken').with_root({'type': 'object'}, {'x': 1})
+        for clone in (copy.copy, copy.deepcopy, lambda error: pickle.loads(pickle.dumps(error))):
+            self.assertEqual(clone(required_error).get_property(), 'x')
+            self.assertEqual(clone(property_error).get_root_schema(), {'type': 'object'})
+            self.assertEqual(clone(property_error).get_root_instance(), {'x': 1})
+
+    @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
+    def test_plain_default_not_revalidated(self):
+        """ default в виде значения не изменяет инстанс, поэтому повторная проверка не выполняется """
+        validator = QueristValidator({'properties': {'amount': {'type': 'integer', 'default': 5}}}, AutoAnswers)
+        with mock.patch.object(validator, '_iter_revalidation_errors') as revalidation:
+            self.assertEqual(list(validator.iter_errors({})), [])
+        revalidation.assert_not_called()
+
+    @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
+    def test_handler_subclass(self):
+        """ Подклассы ошибок без своего обработчика обрабатываются обработчиком базового класса """
+        class CustomDefaultHandler(DefaultHandler):
+            pass
+
+        self.assertIs(self.validator._get_handler(CustomDefaultHandler), QueristValidator._handle_default)
+        self.assertIsNone(self.validator._get_handler(ValidationError))
+
+    @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
+    def test_hashable_enum(self):
+        """ Для хешируемого enum проверка идет по frozenset, на ответ вне enum вопрос задается повторно """
+        question = ConsoleQuestion({'question': 'Select:'}, 'string', ['a', 'b'], True, False)
+        self.assertEqual(question._enum_set, frozenset(['a', 'b']))
+        with mock.patch('builtins.input', side_effect=['zz', 'b']) as console_input, mock.patch('builtins.print'):
+            self.assertEqual(question.ask(), 'b')
+        self.assertEqual(console_input.call_count, 2)
+
+    @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
+    def test_unhashable_enum(self):
+        """ Enum с нехешируемыми значениями проверяется по списку """
+        question = ConsoleQuestion({'question': 'Select:'}, 'string', ['a', ['b']], True, False)
+        with mock.patch('builtins.input', return_value='a'), mock.patch('builtins.print'):
+            self.assertEqual(question.ask(), 'a')
+
+    @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
+    def test_prop_info_not_growing(self):
+        """ Обязательные свойства, не описанные в properties, не добавляют записи в кэш PropInfo """
+        validator = QueristValidator({'required': ['x'], 'properties': {'y': {'type': 'integer'}}}, AutoAnswers)
+        for x in range(3):
+            list(validator.iter_errors({}))
+        self.assertEqual(len(validator._prop_info), 1)
+
+    @unittest.skipIf(jsoncomplete.jsonschema_rs is None, 'jsonschema_rs не установлен\n')
+    def test_fast_validator(self):
+        """ Схема с description в виде объекта компилируется jsonschema_rs """
+        self.assertIsNotNone(self.validator._fast_validator)
+
+    @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
+    def test_has_defaults_registry_released(self):
+        """ Флаги наличия default удаляются вместе с валидатором и не удерживают схемы """
+        registry_len = len(jsoncomplete._has_defaults_registry)
+        # без сборщика циклов: записи должны удаляться сразу при освобождении валидатора по счетчику ссылок
+        gc.disable()
+        try:
+            for x in range(10):
+                QueristValidator(copy.deepcopy(self.validator._schema), AutoAnswers)
+            self.assertEqual(len(jsoncomplete._has_defaults_registry), registry_len)
+        finally:
+            gc.enable()
+
+    @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
+    def testAnswersFileRoundTrip(self):
+        """ Ключи путей различаются для индексов, строк-чисел и имен с '/' и сохраняются без изменений """
+        paths = [('items', 0), ('items', '0'), ('a/b', ), ('a', 'b'), ('a~1', ), ('a/', )]
+        keys = [_path_key(path) for path in paths]
+        self.assertEqual(len(set(keys)), len(paths))
+
+        answers_file = 'output/round_trip.msgpack'
+        answers = {key: {'key_value': {'comment': index}} for index, key in enumerate(keys)}
+        self.validator._answers = answers
+        self.validator.dump_answers(answers_file)
+        new_validator = QueristValidator(self.validator._schema, AutoAnswers, answers_file)
+        os.remove(answers_file)
+
+        self.assertDictEqual(new_validator._answers, answers)
+
+    @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
+    def testLegacyAnswersFile(self):
+        """ Файлы ответов в старом формате pickle по-прежнему загружаются """
+        answers_file = 'output/legacy.pickle'
+        with open(answers_file, 'wb') as f:
+            pickle.dump({('fields', ): {'legacy': {'comment': 'ok'}}}, f, pickle.HIGHEST_PROTOCOL)
+
+        validator = QueristValidator(self.validator._schema, AutoAnswers, answers_file)
+        os.remove(answers_file)
+
+        self.assertDictEqual(validator._answers, {'/fields': {'legacy': {'comment': 'ok'}}})
+
+    @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
+    def testLegacyAnswersFileGlobals(self):
+        """ Файл pickle, ссылающийся на глобальные объекты, не загружается """
+        answers_file = 'output/legacy_globals.pickle'
+        with open(answers_file, 'wb') as f:
+            pickle.dump({('fields', ): collections.OrderedDict()}, f, pickle.HIGHEST_PROTOCOL)
+        try:
+            with self.assertRaises(pickle.UnpicklingError):
+                load_obj(answers_file)
+        finally:
+            os.remove(answers_file)
+
+    @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
+    def testCorruptAnswersFile(self):
+        """ Поврежденный файл msgpack сообщает об ошибке msgpack, а не pickle """
+        answers_file = 'output/corrupt.msgpack'
+        with open(answers_file, 'wb') as f:
+            f.write(b'\xc1')
+        try:
+            with self.assertRaises(ValueError):
+                load_obj(answers_file)
+        finally:
+            os.remove(answers_file)
+
+    @unittest.skipIf(SINGLE_TEST, 'Запускаем тесты выборочно\n')
+    def testAnswersFileArrays(self):
+        """ Массивы в ответах после загрузки остаются списками, а не кортежами """
+        answers_file = 'output/arrays.msgpack'
+        save_obj({'/fields': {'arrays': {'tags': ['a', 'b']}}}, answers_file)
+        answers = load_obj(answers_file)
+        os.remove(answers_file)
+
+        self.assertIsInstance(answers['/fields']['arrays']['tags'], list)
+
     @classmethod
     def tearDownClass(cls):
         pass